@@ -20,3 +20,16 @@ SQLALCHEMY_DATABASE_URI = "postgresql://{}:{}@{}:{}/{}".format(
 )
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 SQLALCHEMY_ENGINE_OPTIONS = {"isolation_level": "READ COMMITTED"}
+DB_CONNECT_TIMEOUT = config("DB_CONNECT_TIMEOUT", default=3, cast=int)
+DB_POOL_TIMEOUT = config("DB_POOL_TIMEOUT", default=3, cast=float)
+
+# Request deadlines (seconds)
+REQUEST_DEADLINE = config("REQUEST_DEADLINE", default=10, cast=float)
+CONNECT_TIMEOUT = config("CONNECT_TIMEOUT", default=3, cast=float)
+DB_WRITE_RESERVE = config("DB_WRITE_RESERVE", default=1, cast=float)
+
+# Hedged Facebook pixel requests
+FB_HEDGE_ENABLED = config("FB_HEDGE_ENABLED", default=False, cast=bool)
+FB_HEDGE_DELAY = config("FB_HEDGE_DELAY", default=0.5, cast=float)
+FB_HEDGE_MIN_SAMPLES = config("FB_HEDGE_MIN_SAMPLES", default=20, cast=int)
+FB_HEDGE_WINDOW = config("FB_HEDGE_WINDOW", default=200, cast=int)
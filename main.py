@@ -1,16 +1,30 @@
 import traceback
+from uuid import uuid4
 from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError, TimeoutError as PoolTimeoutError
 from sqlalchemy.orm import sessionmaker
 
-from config import SQLALCHEMY_DATABASE_URI
+from config import (
+    DB_CONNECT_TIMEOUT,
+    DB_POOL_TIMEOUT,
+    DB_WRITE_RESERVE,
+    FB_HEDGE_ENABLED,
+    REQUEST_DEADLINE,
+    SQLALCHEMY_DATABASE_URI,
+)
 from dataclass import ClickData, ConversionData
 from models import Click, Conversion
 from utils import collector, sender, logger
+from utils.deadline import Deadline, DeadlineExceeded
 
 
-engine = create_engine(SQLALCHEMY_DATABASE_URI)
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URI,
+    connect_args={"connect_timeout": DB_CONNECT_TIMEOUT},
+    pool_timeout=DB_POOL_TIMEOUT,
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 logs = logger.get_logger(__name__)
@@ -34,12 +48,34 @@ async def not_allowed_method():
         status_code=405
         )
 
+def apply_db_deadline(db, timeout: float):
+    '''
+    Limit statements of current transaction to given seconds.
+    '''
+    timeout_ms = max(int(timeout * 1000), 1)
+    db.execute(text(f"SET LOCAL statement_timeout = {timeout_ms}"))
+
+
+def deadline_exceeded_response(error: DeadlineExceeded, sent_events: list = None):
+    logs.error(str(error))
+    msg = "Request deadline exceeded"
+    if sent_events:
+        msg += f". Conversion events {sent_events} sent"
+    return JSONResponse(
+        content={
+            "success": False, 
+            "msg": msg
+            }, 
+        status_code=504
+        )
+
+
 def save_click_to_db(click_data: dict):
     '''
     Save click data to database.
     '''
     db = SessionLocal()
-    click = Click(**click_data)
+    click = Click.from_dump(click_data)
     db.add(click)
     db.commit()
     db.refresh(click)
@@ -47,23 +83,35 @@ def save_click_to_db(click_data: dict):
     logs.info(f"Click saved with ID [{click.id}]")
 
 
-def save_conversion_to_db(conversion_data: dict):
+def save_conversion_to_db(conversion_data: dict, deadline: Deadline):
     '''
     Save conversion data to database.
+    Conversion is already sent at this point, so write always gets at least
+    DB_WRITE_RESERVE seconds even if the request deadline is spent.
     '''
     db = SessionLocal()
-    conversion = Conversion(**conversion_data)
-    db.add(conversion)
-    db.commit()
-    db.refresh(conversion)
-    db.close()
+    try:
+        apply_db_deadline(db, max(deadline.remaining(), DB_WRITE_RESERVE))
+        conversion = Conversion(**conversion_data)
+        db.add(conversion)
+        db.commit()
+        db.refresh(conversion)
+    except (OperationalError, PoolTimeoutError):
+        logs.exception("Conversion sent but not saved")
+        return False
+    finally:
+        db.close()
     logs.info(f"Conversion saved with ID [{conversion.id}]")
+    
+    return True
 
 
-def handle_fb_conversion(conversion_data: ConversionData, click: Click):
+def handle_fb_conversion(conversion_data: ConversionData, click: Click, deadline: Deadline):
     '''
     Handle conversion data for Facebook.
     '''
+    send_deadline = deadline.reserve(DB_WRITE_RESERVE)
+    sent_events = []
     try:
         if conversion_data.event == "install":
             events = ["install", "AddToCart", "ViewContent"]
@@ -77,8 +125,10 @@ def handle_fb_conversion(conversion_data: ConversionData, click: Click):
         for event in events:
             logs.info(f"Sending conversion event {event} to Facebook")
             conversion_data.event = event
+            # Pixel deduplicates on event name + eid. One eid per sent event,
+            # so hedged copies of this send are counted once
             conversion_params = collector.collect_fb_conversion_parameters(
-                conversion_data, click
+                conversion_data, click, uuid4().hex
             )
             if not conversion_params:
                 logs.error(f"Conversion event {event} not found")
@@ -90,7 +140,9 @@ def handle_fb_conversion(conversion_data: ConversionData, click: Click):
                     status_code=404
                     )
             
-            conversion_result = sender.send_conversion_to_fb(conversion_params)
+            conversion_result = sender.send_conversion_to_fb(
+                conversion_params, send_deadline, hedge=FB_HEDGE_ENABLED
+            )
             if not conversion_result['success']:
                 return JSONResponse(
                     content={
@@ -100,11 +152,12 @@ def handle_fb_conversion(conversion_data: ConversionData, click: Click):
                     status_code=500
                     )
             
+            sent_events.append(event)
+            
             conversion_dict = collector.collect_conversion_fields(
                 conversion_data, click, conversion_result
             )
-            if conversion_dict:
-                save_conversion_to_db(conversion_dict)
+            if conversion_dict and save_conversion_to_db(conversion_dict, deadline):
                 logs.info(f"Conversion event {event} sent and saved")
         
         logs.info(f"Conversion events {events} sent")
@@ -115,6 +168,8 @@ def handle_fb_conversion(conversion_data: ConversionData, click: Click):
                 },
             status_code=200
             )
+    except DeadlineExceeded as e:
+        return deadline_exceeded_response(e, sent_events)
     except Exception:
         logs.exception(f"Error occurred while sending conversion to Facebook. {traceback.format_exc()}")
         return JSONResponse(
@@ -166,10 +221,40 @@ async def send_conversion(conversion_data: ConversionData):
     Generate conversion parameters from received data and send conversion to FB.
     '''
     logs.info(f"Received conversion data: {conversion_data}")
+    deadline = Deadline(REQUEST_DEADLINE)
     
+    try:
+        return process_conversion(conversion_data, deadline)
+    except DeadlineExceeded as e:
+        return deadline_exceeded_response(e)
+
+
+def find_click(click_id: str, deadline: Deadline):
+    '''
+    Get click by click_id within request deadline.
+    '''
     db = SessionLocal()
-    click = db.query(Click).filter(Click.click_id == conversion_data.click_id).first()
-    db.close()
+    try:
+        apply_db_deadline(db, deadline.check("click lookup"))
+        return db.query(Click).filter(Click.click_id == click_id).first()
+    except PoolTimeoutError:
+        raise DeadlineExceeded("No database connection available for click lookup")
+    except OperationalError:
+        if not deadline.expired():
+            raise
+        raise DeadlineExceeded(
+            f"Deadline of {deadline.budget}s exceeded during click lookup"
+        )
+    finally:
+        db.close()
+
+
+def process_conversion(conversion_data: ConversionData, deadline: Deadline):
+    '''
+    Find click, send conversion to its source and save it.
+    '''
+    click = find_click(conversion_data.click_id, deadline)
+    send_deadline = deadline.reserve(DB_WRITE_RESERVE)
     if not click:
         logs.error("Click not found")
         return JSONResponse(
@@ -182,7 +267,7 @@ async def send_conversion(conversion_data: ConversionData):
     
     logs.info(f"Sending conversion to {click.click_source}")
     if click.click_source == "facebook":
-        conversion_result = handle_fb_conversion(conversion_data, click)
+        conversion_result = handle_fb_conversion(conversion_data, click, deadline)
         return conversion_result
         
     elif click.click_source == "google":
@@ -199,7 +284,9 @@ async def send_conversion(conversion_data: ConversionData):
                 status_code=404
                 )
         
-        conversion_result = sender.send_conversion_to_google(conversion_params)
+        conversion_result = sender.send_conversion_to_google(
+            conversion_params, send_deadline
+        )
     elif click.click_source == "tiktok":
         conversion_params = collector.collect_tiktok_conversion_parameters(
             conversion_data, click
@@ -214,7 +301,9 @@ async def send_conversion(conversion_data: ConversionData):
                 status_code=404
                 )
         
-        conversion_result = sender.send_conversion_to_tiktok(conversion_params)
+        conversion_result = sender.send_conversion_to_tiktok(
+            conversion_params, send_deadline
+        )
     else:
         logs.error("Click source not supported")
         return JSONResponse(
@@ -229,13 +318,14 @@ async def send_conversion(conversion_data: ConversionData):
         conversion_dict = collector.collect_conversion_fields(
             conversion_data, click, conversion_result
         )
-        if conversion_dict:
-            save_conversion_to_db(conversion_dict)
+        saved = bool(conversion_dict) and save_conversion_to_db(
+            conversion_dict, deadline
+        )
         
         return JSONResponse(
             content={
                 "success": True, 
-                "msg": f"Conversion sent{' but not saved' if not conversion_dict else ''}"
+                "msg": f"Conversion sent{' but not saved' if not saved else ''}"
                 },
             status_code=200
             )
@@ -243,7 +333,7 @@ async def send_conversion(conversion_data: ConversionData):
         return JSONResponse(
             content={
                 "success": False, 
-                "msg": f"Conversion not sent{' and not saved' if not conversion_dict else ''}"
+                "msg": "Conversion not sent"
                 },
             status_code=500
             )
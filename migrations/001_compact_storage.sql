@@ -0,0 +1,121 @@
+-- Compact storage for clicks and conversions.
+--
+-- * clicks.key becomes a 32-byte bytea sha256 digest, other keys move to clicks.key_text
+-- * clicks.domain and clicks.click_source move to domains/click_sources lookup tables
+-- * conversions reference clicks by foreign key instead of copying click columns
+--
+-- Lookup tables may already exist if new code started before this migration.
+-- Run once against existing database before deploying:
+--     psql -h $DB_HOST -p $DB_PORT -U $DB_USER -d $DB_NAME -f migrations/001_compact_storage.sql
+--
+-- Conversion is linked to a click with same click_id, key and copied columns.
+-- Conversions without such click stay unlinked and keep their copied columns.
+-- Migration is aborted if a click with same click_id and key has different columns.
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS domains (
+    id SERIAL PRIMARY KEY,
+    name VARCHAR NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS click_sources (
+    id SMALLSERIAL PRIMARY KEY,
+    name VARCHAR NOT NULL UNIQUE
+);
+
+INSERT INTO domains (name)
+SELECT DISTINCT domain FROM clicks WHERE domain IS NOT NULL
+ON CONFLICT (name) DO NOTHING;
+
+INSERT INTO click_sources (name)
+SELECT DISTINCT click_source FROM clicks WHERE click_source IS NOT NULL
+ON CONFLICT (name) DO NOTHING;
+
+-- Conversions, linked while click columns are still text
+
+ALTER TABLE conversions ADD COLUMN click_pk INTEGER REFERENCES clicks (id);
+
+UPDATE conversions SET click_pk = matched.click_pk
+FROM (
+    SELECT DISTINCT ON (conversions.id)
+        conversions.id AS conversion_id,
+        clicks.id AS click_pk
+    FROM conversions
+    JOIN clicks
+        ON clicks.click_id = conversions.click_id
+        AND clicks.key IS NOT DISTINCT FROM conversions.key
+        AND clicks.domain IS NOT DISTINCT FROM conversions.domain
+        AND clicks.rma IS NOT DISTINCT FROM conversions.rma
+        AND clicks.ulb IS NOT DISTINCT FROM conversions.ulb
+        AND clicks.fbclid IS NOT DISTINCT FROM conversions.fbclid
+        AND clicks.gclid IS NOT DISTINCT FROM conversions.gclid
+        AND clicks.ttclid IS NOT DISTINCT FROM conversions.ttclid
+        AND clicks.initiator IS NOT DISTINCT FROM conversions.initiator
+        AND clicks.click_source IS NOT DISTINCT FROM conversions.conversion_source
+    ORDER BY conversions.id, clicks.id
+) AS matched
+WHERE matched.conversion_id = conversions.id;
+
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1
+        FROM conversions
+        JOIN clicks
+            ON clicks.click_id = conversions.click_id
+            AND clicks.key IS NOT DISTINCT FROM conversions.key
+        WHERE conversions.click_pk IS NULL
+    ) THEN
+        RAISE EXCEPTION 'Conversions differ from their clicks. Migration aborted.';
+    END IF;
+END $$;
+
+-- Copies are only kept for legacy conversions without stored click
+UPDATE conversions SET
+    key = NULL,
+    click_id = NULL,
+    domain = NULL,
+    rma = NULL,
+    ulb = NULL,
+    fbclid = NULL,
+    gclid = NULL,
+    ttclid = NULL,
+    initiator = NULL,
+    conversion_source = NULL
+WHERE click_pk IS NOT NULL;
+
+DROP INDEX IF EXISTS ix_conversions_initiator;
+DROP INDEX IF EXISTS ix_conversions_conversion_source;
+CREATE INDEX ix_conversions_click_pk ON conversions (click_pk);
+
+-- Clicks
+
+ALTER TABLE clicks
+    ADD COLUMN domain_id INTEGER REFERENCES domains (id),
+    ADD COLUMN click_source_id SMALLINT REFERENCES click_sources (id);
+
+UPDATE clicks SET domain_id = domains.id
+FROM domains WHERE domains.name = clicks.domain;
+
+UPDATE clicks SET click_source_id = click_sources.id
+FROM click_sources WHERE click_sources.name = clicks.click_source;
+
+-- Keys that are not lowercase hex sha256 are kept as text
+ALTER TABLE clicks ADD COLUMN key_text VARCHAR;
+
+UPDATE clicks SET key_text = key WHERE key !~ '^[0-9a-f]{64}$';
+
+ALTER TABLE clicks ALTER COLUMN key TYPE BYTEA USING
+    CASE
+        WHEN key ~ '^[0-9a-f]{64}$' THEN decode(key, 'hex')
+    END;
+
+DROP INDEX IF EXISTS ix_clicks_click_source;
+ALTER TABLE clicks
+    DROP COLUMN domain,
+    DROP COLUMN click_source;
+
+CREATE INDEX ix_clicks_click_source_id ON clicks (click_source_id);
+
+COMMIT;
@@ -1,13 +1,82 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean
-from sqlalchemy.sql import func
+import re
+
+from sqlalchemy import (
+    create_engine,
+    Column,
+    ForeignKey,
+    Integer,
+    LargeBinary,
+    SmallInteger,
+    String,
+    DateTime,
+    Boolean,
+)
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import relationship
+from sqlalchemy.sql import func, select
 from sqlalchemy.ext.declarative import declarative_base
 
-from config import SQLALCHEMY_DATABASE_URI
+from config import DB_CONNECT_TIMEOUT, DB_POOL_TIMEOUT, SQLALCHEMY_DATABASE_URI
 
 
-engine = create_engine(SQLALCHEMY_DATABASE_URI)
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URI,
+    connect_args={"connect_timeout": DB_CONNECT_TIMEOUT},
+    pool_timeout=DB_POOL_TIMEOUT,
+)
 Base = declarative_base()
 
+# Lookup values never change once stored, so ids are cached per process
+lookup_cache = {}
+
+
+def get_lookup_id(model, name: str):
+    '''
+    Get id of lookup value, storing it first if it does not exist yet.
+    '''
+    if name is None:
+        return None
+    
+    cache_key = (model.__tablename__, name)
+    if cache_key not in lookup_cache:
+        with engine.begin() as conn:
+            conn.execute(
+                insert(model)
+                .values(name=name)
+                .on_conflict_do_nothing(index_elements=["name"])
+            )
+            lookup_cache[cache_key] = conn.execute(
+                select(model.id).where(model.name == name)
+            ).scalar_one()
+    
+    return lookup_cache[cache_key]
+
+
+def encode_key(key: str):
+    '''
+    Split key into 32-byte digest and text fallback.
+    Only lowercase hex sha256 keys are stored as digest, so every key is
+    returned exactly as it was received.
+    '''
+    if key is not None and re.fullmatch("[0-9a-f]{64}", key):
+        return bytes.fromhex(key), None
+    
+    return None, key
+
+
+class Domain(Base):
+    __tablename__ = "domains"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String, unique=True, nullable=False)
+
+
+class ClickSource(Base):
+    __tablename__ = "click_sources"
+
+    id = Column(SmallInteger, primary_key=True)
+    name = Column(String, unique=True, nullable=False)
+
 
 class Click(Base):
     __tablename__ = "clicks"
@@ -16,10 +85,11 @@ class Click(Base):
     click_id = Column(String)
     service_tag = Column(String)
     user_agent = Column(String)
-    key = Column(String)
+    key = Column(LargeBinary(32))
+    key_text = Column(String)
     initiator = Column(String, index=True)
-    click_source = Column(String, index=True)
-    domain = Column(String)
+    click_source_id = Column(SmallInteger, ForeignKey("click_sources.id"), index=True)
+    domain_id = Column(Integer, ForeignKey("domains.id"))
     rma = Column(String)
     ulb = Column(Integer)
     xcn = Column(Integer)
@@ -28,11 +98,37 @@ class Click(Base):
     ttclid = Column(String)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
+    click_source_ref = relationship("ClickSource", lazy="joined")
+    domain_ref = relationship("Domain", lazy="joined")
+
+    @property
+    def click_source(self):
+        return self.click_source_ref.name if self.click_source_ref else None
+
+    @property
+    def domain(self):
+        return self.domain_ref.name if self.domain_ref else None
+
+    @classmethod
+    def from_dump(cls, click_data: dict):
+        '''
+        Build click from API fields, encoding key and lookup values.
+        '''
+        click_data = dict(click_data)
+        click_data["key"], click_data["key_text"] = encode_key(click_data.get("key"))
+        click_data["click_source_id"] = get_lookup_id(
+            ClickSource, click_data.pop("click_source", None)
+        )
+        click_data["domain_id"] = get_lookup_id(
+            Domain, click_data.pop("domain", None)
+        )
+        return cls(**click_data)
+
     def model_dump(self):
         return {
             "id": self.id,
             "click_id": self.click_id,
-            "key": self.key,
+            "key": self.key.hex() if self.key else self.key_text,
             "initiator": self.initiator,
             "click_source": self.click_source,
             "domain": self.domain,
@@ -50,44 +146,78 @@ class Conversion(Base):
     __tablename__ = 'conversions'
 
     id = Column(Integer, primary_key=True, index=True)
+    click_pk = Column(Integer, ForeignKey("clicks.id"), index=True)
+    event = Column(String, index=True)
+    appclid = Column(String)
+    clabel = Column(String)
+    gtag = Column(String)
+    conversion_url = Column(String)
+    is_sent = Column(Boolean, default=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    # Copies of click fields, only filled for legacy conversions without stored click
     key = Column(String)
     click_id = Column(String)
     domain = Column(String)
-    event = Column(String, index=True)
     rma = Column(String)
     ulb = Column(Integer)
     fbclid = Column(String)
     gclid = Column(String)
     ttclid = Column(String)
-    appclid = Column(String)
-    clabel = Column(String)
-    gtag = Column(String)
-    initiator = Column(String, index=True)
-    conversion_source = Column(String, index=True)
-    conversion_url = Column(String)
-    is_sent = Column(Boolean, default=False)
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    initiator = Column(String)
+    conversion_source = Column(String)
+
+    click = relationship("Click", lazy="joined")
+
+    def click_fields(self):
+        '''
+        Get click fields from linked click or from legacy copies.
+        '''
+        if self.click is None:
+            return {
+                "click_id": self.click_id,
+                "domain": self.domain,
+                "rma": self.rma,
+                "ulb": self.ulb,
+                "fbclid": self.fbclid,
+                "gclid": self.gclid,
+                "ttclid": self.ttclid,
+                "initiator": self.initiator,
+                "conversion_source": self.conversion_source,
+            }
+        
+        return {
+            "click_id": self.click.click_id,
+            "domain": self.click.domain,
+            "rma": self.click.rma,
+            "ulb": self.click.ulb,
+            "fbclid": self.click.fbclid,
+            "gclid": self.click.gclid,
+            "ttclid": self.click.ttclid,
+            "initiator": self.click.initiator,
+            "conversion_source": self.click.click_source,
+        }
     
     def model_dump(self):
+        click = self.click_fields()
         return {
             "id": self.id,
-            "click_id": self.click_id,
-            "domain": self.domain,
+            "click_id": click["click_id"],
+            "domain": click["domain"],
             "event": self.event,
-            "rma": self.rma,
-            "ulb": self.ulb,
-            "fbclid": self.fbclid,
-            "gclid": self.gclid,
-            "ttclid": self.ttclid,
+            "rma": click["rma"],
+            "ulb": click["ulb"],
+            "fbclid": click["fbclid"],
+            "gclid": click["gclid"],
+            "ttclid": click["ttclid"],
             "appclid": self.appclid,
             "clabel": self.clabel,
             "gtag": self.gtag,
-            "initiator": self.initiator,
-            "conversion_source": self.conversion_source,
+            "initiator": click["initiator"],
+            "conversion_source": click["conversion_source"],
             "conversion_url": self.conversion_url,
             "is_sent": self.is_sent,
             "created_at": self.created_at.strftime("%Y-%m-%d %H:%M:%S")
         }
 
-
 Base.metadata.create_all(bind=engine)
\ No newline at end of file
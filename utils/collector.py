@@ -48,7 +48,7 @@ def collect_click_parameters(click_data: ClickData, request: Request):
     return click_dict
 
 
-def collect_fb_conversion_parameters(conversion_data: ConversionData, click: Click):
+def collect_fb_conversion_parameters(conversion_data: ConversionData, click: Click, event_id: str):
     logs.info("Received conversion data. Generating conversion parameters.")
     
     conversion_params = {
@@ -109,6 +109,7 @@ def collect_fb_conversion_parameters(conversion_data: ConversionData, click: Cli
     conversion_params = {
         'id': click.rma,
         'ev': event_params['ev'],
+        'eid': event_id,
         'dl': click.domain,
         'rl': '',
         'if': 'false',
@@ -176,20 +177,11 @@ def collect_conversion_fields(conversion_data: ConversionData, click: Click, con
     
     try:
         conversion_fields = {
-            "key": click.key,
-            "click_id": click.click_id,
-            "domain": click.domain,
+            "click_pk": click.id,
             "event": conversion_data.event,
-            "rma": click.rma,
-            "ulb": click.ulb,
-            "fbclid": click.fbclid,
-            "gclid": click.gclid,
-            "ttclid": click.ttclid,
             "appclid": conversion_data.appclid,
             "clabel": conversion_data.clabel,
             "gtag": conversion_data.gtag,
-            "initiator": click.initiator,
-            "conversion_source": click.click_source,
             "conversion_url": conversion_result.get("url"),
             "is_sent": conversion_result.get("success"),
         }
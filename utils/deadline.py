@@ -0,0 +1,39 @@
+import time
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline:
+    '''
+    Time budget of a single request, shared by every step it triggers.
+    '''
+    def __init__(self, budget: float):
+        self.budget = budget
+        self.expires_at = time.monotonic() + budget
+
+    def reserve(self, seconds: float) -> "Deadline":
+        '''
+        Return deadline ending given seconds earlier, leaving them for later steps.
+        '''
+        deadline = Deadline(self.budget)
+        deadline.expires_at = self.expires_at - seconds
+        return deadline
+
+    def remaining(self) -> float:
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def check(self, stage: str) -> float:
+        '''
+        Return remaining seconds or raise DeadlineExceeded if budget is spent.
+        '''
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded(
+                f"Deadline of {self.budget}s exceeded before {stage}"
+            )
+        return remaining
@@ -1,13 +1,231 @@
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from socket import SHUT_RDWR
+from threading import BoundedSemaphore, Lock
+from time import monotonic
 from urllib.parse import urlencode
 import requests
+from urllib3.exceptions import HTTPError, ReadTimeoutError
 
+from config import (
+    CONNECT_TIMEOUT,
+    FB_HEDGE_DELAY,
+    FB_HEDGE_MIN_SAMPLES,
+    FB_HEDGE_WINDOW,
+)
 from utils import logger
+from utils.deadline import Deadline, DeadlineExceeded
 
 
 logs = logger.get_logger(__name__)
 
+fb_latencies = deque(maxlen=FB_HEDGE_WINDOW)
+hedge_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="fb-hedge")
+hedge_slots = BoundedSemaphore(8)
 
-def send_conversion_to_fb(conversion_params: dict):
+
+class Cancellation:
+    '''
+    Cancels running requests by shutting down sockets of their responses,
+    so blocked reads return at once and free their threads.
+    '''
+    def __init__(self):
+        self.lock = Lock()
+        self.cancelled = False
+        self.sockets = set()
+
+    def is_set(self):
+        return self.cancelled
+
+    def register(self, response):
+        sock = get_socket(response)
+        if sock is None:
+            return
+        with self.lock:
+            if not self.cancelled:
+                self.sockets.add(sock)
+                return
+        shutdown_socket(sock)
+
+    def unregister(self, response):
+        with self.lock:
+            self.sockets.discard(get_socket(response))
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            sockets, self.sockets = self.sockets, set()
+        for sock in sockets:
+            shutdown_socket(sock)
+
+
+def get_socket(response):
+    connection = response.raw.connection
+    return connection.sock if connection is not None else None
+
+
+def shutdown_socket(sock):
+    try:
+        sock.shutdown(SHUT_RDWR)
+    except OSError:
+        pass
+
+
+def set_read_timeout(response, timeout: float):
+    '''
+    Reset socket timeout of response connection before next read.
+    '''
+    sock = get_socket(response)
+    if sock is not None:
+        sock.settimeout(timeout)
+
+
+def request_with_deadline(method: str, url: str, deadline: Deadline, stage: str, cancellation: Cancellation = None, **kwargs):
+    '''
+    Send request bounded by the deadline.
+    Body is read with read1 and socket timeout is reset to remaining budget
+    before every read, so slow-dripping upstream is cut off. Response that is
+    already complete when the deadline is reached is still returned.
+    '''
+    remaining = deadline.check(stage)
+    try:
+        response = requests.request(
+            method,
+            url,
+            timeout=(min(CONNECT_TIMEOUT, remaining), remaining),
+            stream=True,
+            **kwargs,
+        )
+        with response:
+            if cancellation is not None:
+                cancellation.register(response)
+            try:
+                chunks = []
+                while True:
+                    # After the deadline only data that already arrived is read
+                    set_read_timeout(response, max(deadline.remaining(), 0.01))
+                    chunk = response.raw.read1(1024, decode_content=True)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+            finally:
+                if cancellation is not None:
+                    cancellation.unregister(response)
+            if cancellation is not None and cancellation.is_set():
+                return None
+            response._content = b"".join(chunks)
+    except (requests.Timeout, ReadTimeoutError):
+        raise DeadlineExceeded(
+            f"Deadline of {deadline.budget}s exceeded during {stage}"
+        )
+    except (requests.ConnectionError, HTTPError):
+        if cancellation is not None and cancellation.is_set():
+            return None
+        if not deadline.expired():
+            raise
+        raise DeadlineExceeded(
+            f"Deadline of {deadline.budget}s exceeded during {stage}"
+        )
+    
+    return response
+
+
+def get_fb_hedge_delay():
+    '''
+    Return p95 of recent Facebook latencies or configured delay until enough samples.
+    '''
+    if len(fb_latencies) < FB_HEDGE_MIN_SAMPLES:
+        return FB_HEDGE_DELAY
+    
+    latencies = sorted(fb_latencies)
+    return latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)]
+
+
+def request_fb(url: str, params: dict, deadline: Deadline, cancellation: Cancellation = None):
+    '''
+    Send request to FB recording its latency, including failed and timed out requests.
+    '''
+    if cancellation is not None and cancellation.is_set():
+        return None
+    
+    started_at = monotonic()
+    try:
+        return request_with_deadline(
+            "GET", url, deadline, "Facebook send", cancellation, params=params
+        )
+    finally:
+        fb_latencies.append(monotonic() - started_at)
+
+
+def submit_fb_request(url: str, params: dict, deadline: Deadline, cancellation: Cancellation):
+    '''
+    Submit request to FB to hedge pool or return None if pool has no free thread.
+    '''
+    if not hedge_slots.acquire(blocking=False):
+        return None
+    
+    future = hedge_executor.submit(request_fb, url, params, deadline, cancellation)
+    future.add_done_callback(lambda _: hedge_slots.release())
+    return future
+
+
+def send_hedged_fb_request(url: str, params: dict, deadline: Deadline):
+    '''
+    Send request to FB and a second one if first is slower than p95 latency.
+    First successful response wins, the other one is cancelled.
+    Hedging is skipped while hedge pool has no free thread.
+    '''
+    cancellation = Cancellation()
+    first = submit_fb_request(url, params, deadline, cancellation)
+    if first is None:
+        logs.info("Hedge pool is busy. Sending Facebook request without hedging.")
+        return request_fb(url, params, deadline)
+    
+    futures = [first]
+    try:
+        done, _ = wait(
+            futures, timeout=min(get_fb_hedge_delay(), deadline.remaining())
+        )
+        if done:
+            return futures[0].result()
+        
+        deadline.check("hedged Facebook send")
+        second = submit_fb_request(url, params, deadline, cancellation)
+        if second is None:
+            logs.info("Hedge pool is busy. Waiting for first Facebook request.")
+        else:
+            logs.info("Facebook response is slow. Sending hedged request.")
+            futures.append(second)
+        
+        pending = set(futures)
+        response = None
+        error = None
+        while pending:
+            done, pending = wait(
+                pending, timeout=deadline.remaining(), return_when=FIRST_COMPLETED
+            )
+            if not done:
+                raise DeadlineExceeded(
+                    f"Deadline of {deadline.budget}s exceeded during Facebook send"
+                )
+            for future in done:
+                if future.exception():
+                    error = future.exception()
+                    continue
+                response = future.result()
+                if response is not None and response.status_code == 200:
+                    return response
+        
+        if response is not None:
+            return response
+        raise error
+    finally:
+        cancellation.cancel()
+        for future in futures:
+            future.cancel()
+
+
+def send_conversion_to_fb(conversion_params: dict, deadline: Deadline, hedge: bool = False):
     logs.info("Sending conversion to FB.")
     
     conversion_url = "https://www.facebook.com/tr/"
@@ -19,7 +237,12 @@ def send_conversion_to_fb(conversion_params: dict):
     )
 
     logs.info(f"Conversion request url: {full_conversion_url}")
-    response = requests.get(full_conversion_url, params=conversion_params)
+    if hedge:
+        response = send_hedged_fb_request(
+            full_conversion_url, conversion_params, deadline
+        )
+    else:
+        response = request_fb(full_conversion_url, conversion_params, deadline)
     # full_response_url = response.url
     if response.status_code == 200:
         logs.info("Conversion sent")
@@ -30,12 +253,14 @@ def send_conversion_to_fb(conversion_params: dict):
         
         return {"success": False, "url": full_conversion_url}
     
-def send_conversion_to_google(conversion_params: dict):
+def send_conversion_to_google(conversion_params: dict, deadline: Deadline):
     logs.info("Sending conversion to Google.")
     
     conversion_url = "http://164.90.189.159/selenium/"
     
-    response = requests.post(conversion_url, json=conversion_params)
+    response = request_with_deadline(
+        "POST", conversion_url, deadline, "Google send", json=conversion_params
+    )
     if response.status_code == 200:
         logs.info("Conversion sent")
         
@@ -45,7 +270,7 @@ def send_conversion_to_google(conversion_params: dict):
         
         return {"success": False, "url": conversion_url}
 
-def send_conversion_to_tiktok(conversion_params: dict):
+def send_conversion_to_tiktok(conversion_params: dict, deadline: Deadline):
     logs.info("Sending conversion to TikTok.")
     
     conversion_url = "http://example.com/tiktok/"
@@ -57,7 +282,9 @@ def send_conversion_to_tiktok(conversion_params: dict):
         "user_agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/"
     }
     
-    response = requests.post(conversion_url, json=args)
+    response = request_with_deadline(
+        "POST", conversion_url, deadline, "TikTok send", json=args
+    )
     if response.status_code == 200:
         logs.info("Conversion sent")
         
@@ -65,4 +292,4 @@ def send_conversion_to_tiktok(conversion_params: dict):
     else:
         logs.error(f"Conversion not sent. Response: {response.text}")
         
-        return {"success": False, "url": conversion_url}
\ No newline at end of file
+        return {"success": False, "url": conversion_url}